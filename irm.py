@@ -68,8 +68,9 @@ class InvariantRiskMinimization(object):
         for iteration in range(args.number_IRM_iterations):
             penalty = 0
             error = 0
+            solution = self.solution()
             for x_e, y_e in environments:
-                error_e = loss(x_e @ self.phi @ self.w, y_e)
+                error_e = loss(x_e @ solution, y_e)
                 gradient = grad(error_e, self.w, create_graph=True)
                 penalty += gradient[0].pow(2).mean()
                 error += error_e
@@ -117,8 +118,8 @@ def IRM_T_block(environments, args):
     return irm_coeff
 
 def get_irm_features(x_train, t_train, y_train, e_train, number_environments, group_indicator, feature_indices, args):
-    T_group = np.where(t_train.to_numpy().reshape(-1, 1) == group_indicator)[0]
-    environments_group = envs_irm_T(x_train.to_numpy()[T_group,:], y_train.to_numpy().reshape(-1, 1)[T_group,:], e_train.to_numpy().reshape(-1, 1)[T_group,:], number_environments)
+    T_group = np.where(np.asarray(t_train).reshape(-1, 1) == group_indicator)[0]
+    environments_group = envs_irm_T(np.asarray(x_train)[T_group,:], np.asarray(y_train).reshape(-1, 1)[T_group,:], np.asarray(e_train).reshape(-1, 1)[T_group,:], number_environments)
     irm_group_coeff  = IRM_T_block(environments_group, args)
     irm_group_coeff = irm_group_coeff.detach().numpy()[1:]
     kmeans = KMeans(n_clusters=2, random_state=0).fit(np.absolute(irm_group_coeff))
@@ -13,18 +13,14 @@ Description: Code to compare with Entner et al. (2013)
 
 """
 
+import os
 import time
 import argparse
 import multiprocessing
 import numpy as np
-import pandas as pd
 from functools import partial
-from sklearn.preprocessing import StandardScaler
-from scipy.special import softmax, expit
-from contextlib import contextmanager
+from numba import njit
 from multiprocessing import get_context
-from multiprocessing import set_start_method
-from sklearn.model_selection import train_test_split
 
 import rpy2.robjects as ro
 import rpy2.robjects.numpy2ri
@@ -32,78 +28,116 @@ rpy2.robjects.numpy2ri.activate()
 from rpy2.robjects.packages import importr
 importr('RCIT')
 RCoT = ro.r('RCoT')
+RCoT_batch = ro.r('RCoT_batch <- function(x, y, z_list) sapply(z_list, function(z) RCoT(x, y, z)[[1]])')
+run_rcot_batch = ro.r('function(x_list, y_list, z_lists) t(mapply(RCoT_batch, x_list, y_list, z_lists))')
 
-@contextmanager
-def poolcontext(*args, **kwargs):
-  pool = multiprocessing.Pool(*args, **kwargs)
-  yield pool
-  pool.terminate()
-
-def get_u(number_observations,number_dimensions):
-  u1 = np.random.uniform(1.0,2.0,(number_observations,1))
-  u2 = np.random.uniform(1.0,2.0,(number_observations,number_dimensions))
-  u3 = np.random.uniform(1.0,2.0,(number_observations,number_dimensions))
-  u4 = np.random.uniform(1.0,2.0,(number_observations,number_dimensions))
+rng = np.random.default_rng()
+
+def uniform(low,high,size):
+  return low + (high-low) * rng.random(size, dtype=np.float32)
+
+def get_u(number_repetitions,number_observations,number_dimensions):
+  u1 = uniform(1.0,2.0,(number_repetitions,number_observations,1))
+  u2 = uniform(1.0,2.0,(number_repetitions,number_observations,number_dimensions))
+  u3 = uniform(1.0,2.0,(number_repetitions,number_observations,number_dimensions))
+  u4 = uniform(1.0,2.0,(number_repetitions,number_observations,number_dimensions))
   return u1,u2,u3,u4
 
-def get_theta(number_dimensions,use_t_in_e,number_environments):
-  theta1 = np.random.uniform(1.0,2.0,(number_dimensions+1,1))
-  theta2 = np.random.uniform(1.0,2.0,(number_dimensions*2+1,number_dimensions))
-  theta3 = np.random.uniform(1.0,2.0,(number_dimensions*2,number_dimensions))
-  theta4 = np.random.uniform(1.0,2.0,(number_dimensions*2+1,1))
-  theta5 = np.random.uniform(1.0,2.0,(2,1))
+def get_theta(number_repetitions,number_dimensions,use_t_in_e,number_environments):
+  theta1 = uniform(1.0,2.0,(number_repetitions,number_dimensions+1,1))
+  theta2 = uniform(1.0,2.0,(number_repetitions,number_dimensions*2+1,number_dimensions))
+  theta3 = uniform(1.0,2.0,(number_repetitions,number_dimensions*2,number_dimensions))
+  theta4 = uniform(1.0,2.0,(number_repetitions,number_dimensions*2+1,1))
+  theta5 = uniform(1.0,2.0,(number_repetitions,2,1))
   if use_t_in_e == 0:
-    theta6 = np.concatenate((np.random.uniform(1.0,2.0,(1,1)), np.zeros((1,1)), np.random.uniform(-1.0,-2.0,(1,1))), axis = 1)
+    theta6 = np.concatenate((uniform(1.0,2.0,(number_repetitions,1,1)), np.zeros((number_repetitions,1,1), dtype=np.float32), uniform(-2.0,-1.0,(number_repetitions,1,1))), axis = 2)
   else:
-    theta6 = np.concatenate((np.random.uniform(1.0,2.0,(2,1)), np.zeros((2,1)), np.random.uniform(-1.0,-2.0,(2,1))), axis = 1)
+    theta6 = np.concatenate((uniform(1.0,2.0,(number_repetitions,2,1)), np.zeros((number_repetitions,2,1), dtype=np.float32), uniform(-2.0,-1.0,(number_repetitions,2,1))), axis = 2)
   return theta1, theta2, theta3, theta4, theta5, theta6
 
-def get_data(u1,u2,u3,u4,theta1,theta2,theta3,theta4,theta5,theta6,number_observations,number_dimensions,use_t_in_e,number_environments):
-  x1 = np.dot(np.concatenate((u1,u2),axis=1), theta1) + 0.1* np.random.normal(0,1,(number_observations,1))
-  x2 = np.dot(np.concatenate((x1,u2,u3),axis=1), theta2) + 0.1* np.random.normal(0,1,(number_observations,number_dimensions))
-  x3 = np.dot(np.concatenate((u3,u4),axis=1), theta3) + 0.1 * np.random.normal(0,1,(number_observations,number_dimensions))
-  t = np.random.binomial(1, expit(np.dot(np.concatenate((u1, x1), axis = 1), theta5)-np.mean(np.dot(np.concatenate((u1, x1), axis = 1), theta5))))
+@njit(cache=True, fastmath=True)
+def sample_treatment(z, rng):
+  t = np.empty(z.shape, dtype=np.int64)
+  for i in range(z.shape[0]):
+    t[i,0] = 1 if rng.random() < 1.0/(1.0+np.exp(-z[i,0])) else 0
+  return t
+
+@njit(cache=True, fastmath=True)
+def sample_environments(z, rng):
+  e = np.empty((z.shape[0],1), dtype=np.int64)
+  weights = np.empty(z.shape[1])
+  for i in range(z.shape[0]):
+    m = np.max(z[i])
+    s = 0.0
+    for k in range(z.shape[1]):
+      weights[k] = np.exp(z[i,k]-m)
+      s += weights[k]
+    u = rng.random() * s
+    k = 0
+    c = weights[0]
+    while u >= c and k < z.shape[1]-1:
+      k += 1
+      c += weights[k]
+    e[i,0] = k
+  return e
+
+def get_data(u1,u2,u3,u4,theta1,theta2,theta3,theta4,theta5,theta6,number_repetitions,number_observations,number_dimensions,use_t_in_e,number_environments):
+  x1 = np.matmul(u1, theta1[:,:1]) + np.matmul(u2, theta1[:,1:]) + 0.1* rng.standard_normal((number_repetitions,number_observations,1), dtype=np.float32)
+  x2 = np.matmul(x1, theta2[:,:1]) + np.matmul(u2, theta2[:,1:number_dimensions+1]) + np.matmul(u3, theta2[:,number_dimensions+1:]) + 0.1* rng.standard_normal((number_repetitions,number_observations,number_dimensions), dtype=np.float32)
+  x3 = np.matmul(u3, theta3[:,:number_dimensions]) + np.matmul(u4, theta3[:,number_dimensions:]) + 0.1 * rng.standard_normal((number_repetitions,number_observations,number_dimensions), dtype=np.float32)
+  z_t = np.matmul(u1, theta5[:,:1]) + np.matmul(x1, theta5[:,1:])
+  z_t -= np.mean(z_t, axis = 1, keepdims = True)
+  t = sample_treatment(z_t.reshape(-1,1), rng).reshape(z_t.shape)
   if use_t_in_e == 0:
-    probabilites = softmax(np.dot(x1, theta6)-np.mean(np.dot(x1, theta6), axis = 0), axis = 1)
+    z_e = np.matmul(x1, theta6)
   else:
-    probabilites = softmax(np.dot(np.concatenate((x1, t), axis = 1), theta6)-np.mean(np.dot(np.concatenate((x1, t), axis = 1), theta6), axis = 0 ),  axis = 1)
-  e = np.zeros((number_observations,1), dtype=int)
-  for i,probability in enumerate(probabilites):
-    e[i,:] = np.random.choice(np.arange(number_environments), p = probability)
-
-  zeros =  np.zeros((number_observations,1))
-  ones =  np.ones((number_observations,1))
-  noise = 0.1 * np.random.normal(0,1,(number_observations,1))
-  y = np.dot(np.concatenate((x2,u4,t),axis=1),theta4) + noise
-  y_0 = np.dot(np.concatenate((x2,u4,zeros),axis=1),theta4) + noise
-  y_1 = np.dot(np.concatenate((x2,u4,ones),axis=1),theta4) + noise
-
-  return x1,x2,x3,t,e,y,y_0,y_1
-
-def get_train_test_data(number_observations,number_dimensions,use_t_in_e,number_environments):
-  u1,u2,u3,u4 = get_u(number_observations,number_dimensions)
-  theta1, theta2, theta3, theta4, theta5, theta6 = get_theta(number_dimensions,use_t_in_e,number_environments)
-  x1,x2,x3,t,e,y,y_0,y_1 = get_data(u1,u2,u3,u4,theta1,theta2,theta3,theta4,theta5,theta6,number_observations,number_dimensions,use_t_in_e,number_environments)
-  true_ate = np.round(np.mean(y_1 - y_0),6)
-  features_train, features_test, t_train, t_test, y_train, y_test, e_train, e_test, y_0_train, y_0_test, y_1_train, y_1_test = train_test_split(np.concatenate((x1,x2,x3),axis=1), t, y, e, y_0, y_1, test_size=0.2)
-  x_train = pd.DataFrame(features_train)
-  x_train.columns = list(map(str, range(2*number_dimensions+1)))
-  x_train.columns = pd.MultiIndex.from_arrays([['x1' for i in range(1)] + ['x2' for i in range(number_dimensions)] + ['x3' for i in range(number_dimensions)], list(x_train.columns)]) 
-  t_train = pd.Series(t_train[:,0])
-  y_train = pd.Series(y_train[:,0])
-  e_train = pd.Series(e_train[:,0])
-  y_0_train = pd.Series(y_0_train[:,0])
-  y_1_train = pd.Series(y_1_train[:,0])
-  x_test = pd.DataFrame(features_test)
-  x_test.columns = list(map(str, range(2*number_dimensions+1)))
-  x_test.columns = pd.MultiIndex.from_arrays([['x1' for i in range(1)] + ['x2' for i in range(number_dimensions)] + ['x3' for i in range(number_dimensions)], list(x_test.columns)]) 
-  t_test = pd.Series(t_test[:,0])
-  y_test = pd.Series(y_test[:,0])
-  e_test = pd.Series(e_test[:,0])
-  y_0_test = pd.Series(y_0_test[:,0])
-  y_1_test = pd.Series(y_1_test[:,0])
-  return x_train, t_train, y_train, e_train, y_0_train, y_1_train, x_test, t_test, y_test, e_test, y_0_test, y_1_test, true_ate
-
+    z_e = np.matmul(x1, theta6[:,:1]) + np.matmul(t.astype(np.float32), theta6[:,1:])
+  z_e -= np.mean(z_e, axis = 1, keepdims = True)
+  if z_e.shape[-1] != number_environments:
+    raise ValueError("theta6 defines %d environments, but number_environments is %d" % (z_e.shape[-1], number_environments))
+  e = sample_environments(z_e.reshape(-1,z_e.shape[-1]), rng).reshape(z_t.shape)
+
+  noise = 0.1 * rng.standard_normal((number_repetitions,number_observations,1), dtype=np.float32)
+  y = np.matmul(x2, theta4[:,:number_dimensions]) + np.matmul(u4, theta4[:,number_dimensions:2*number_dimensions]) + t.astype(np.float32) * theta4[:,-1:] + noise
+
+  return x1,x2,x3,t,e,y
+
+def get_train_test_data(number_repetitions,number_observations,number_dimensions,use_t_in_e,number_environments):
+  u1,u2,u3,u4 = get_u(number_repetitions,number_observations,number_dimensions)
+  theta1, theta2, theta3, theta4, theta5, theta6 = get_theta(number_repetitions,number_dimensions,use_t_in_e,number_environments)
+  x1,x2,x3,t,e,y = get_data(u1,u2,u3,u4,theta1,theta2,theta3,theta4,theta5,theta6,number_repetitions,number_observations,number_dimensions,use_t_in_e,number_environments)
+  data = np.concatenate((x1,x2,x3,y,t,e),axis=2,dtype=np.float32)
+  del u1,u2,u3,u4,x1,x2,x3,t,e,y
+  columns = np.cumsum([1,number_dimensions,number_dimensions,1,1])
+  number_test = int(np.ceil(0.2*number_observations))
+  for r in range(number_repetitions):
+    true_ate = round(float(theta4[r,-1,0]),6)
+    permutation = rng.permutation(number_observations)
+    data_train, data_test = data[r,permutation[number_test:]], data[r,permutation[:number_test]]
+    x1_train, x2_train, x3_train, y_train, t_train, e_train = np.split(data_train, columns, axis=1)
+    x1_test, x2_test, x3_test, y_test, t_test, e_test = np.split(data_test, columns, axis=1)
+    t_train, e_train, t_test, e_test = t_train.astype(np.int64), e_train.astype(np.int64), t_test.astype(np.int64), e_test.astype(np.int64)
+    yield x1_train, x2_train, x3_train, t_train, y_train, e_train, x1_test, x2_test, x3_test, t_test, y_test, e_test, true_ate
+
+
+def concatenate_columns(arrays):
+  # numpy2ri copies matrices into R in column-major order, so a Fortran-ordered buffer is passed without reordering
+  concatenated = np.empty((arrays[0].shape[0], sum(array.shape[1] for array in arrays)), order='F')
+  return np.concatenate(arrays, axis=1, out=concatenated)
+
+def run_batch(task,number_observations,use_t_in_e,number_environments):
+  i, number_dimensions, repetitions = task
+  e_list = []
+  y_list = []
+  z_lists = []
+  for r, (x1_train, x2_train, x3_train, t_train, y_train, e_train, x1_test, x2_test, x3_test, t_test, y_test, e_test, true_ate) in zip(repetitions, get_train_test_data(len(repetitions),number_observations,number_dimensions,use_t_in_e,number_environments)):
+    print(r+1, 2*number_dimensions+1)
+    e_list.append(e_train)
+    y_list.append(y_train.astype(np.float64))
+    z_lists.append(ro.r['list'](t_train,concatenate_columns((x3_train,t_train)),concatenate_columns((x2_train,x3_train,t_train))))
+
+  pvalues = np.asarray(run_rcot_batch(ro.r['list'](*e_list),ro.r['list'](*y_list),ro.r['list'](*z_lists)))
+  return [(r, i, pvalues[k,0], pvalues[k,1], pvalues[k,2]) for k, r in enumerate(repetitions)]
 
 def main(args):
 
@@ -112,29 +146,27 @@ def main(args):
   number_observations = args.no
   use_t_in_e = args.use_t_in_e
   number_environments = args.ne
+  number_processes = multiprocessing.cpu_count()
   number_dimensions_list = [2,7,12]
 
   pvalue_empty = np.zeros((number_repetitions,len(number_dimensions_list)))
   pvalue_x3 = np.zeros((number_repetitions,len(number_dimensions_list)))
   pvalue_x2x3 = np.zeros((number_repetitions,len(number_dimensions_list)))
 
-  for r in range(number_repetitions):
-    print(r+1)
-    for i, number_dimensions in enumerate(number_dimensions_list):
-        print(2*number_dimensions+1)
-        x_train, t_train, y_train, e_train, y_0_train, y_1_train, x_test, t_test, y_test, e_test, y_0_test, y_1_test, true_ate = get_train_test_data(number_observations,number_dimensions,use_t_in_e,number_environments)
-
-        x2_n = StandardScaler().fit_transform(np.array(x_train[['x2']]))
-        x3_n = StandardScaler().fit_transform(np.array(x_train[['x3']]))
-        y_n = StandardScaler().fit_transform(np.array(y_train).reshape(-1, 1))
-        t = np.array(t_train).reshape(-1, 1)
-        e = np.array(e_train).reshape(-1, 1)
-
-        pvalue_empty[r,i] = RCoT(e,y_n,t)[0]
-        pvalue_x3[r,i] = RCoT(e,y_n,np.concatenate((x3_n,t),axis=1))[0]
-        pvalue_x2x3[r,i] = RCoT(e,y_n,np.concatenate((x2_n,x3_n,t),axis=1))[0]
-
-    print(time.time() - starting_time)
+  # spawned workers inherit these before importing numpy/torch, so each worker runs single-threaded BLAS/OpenMP
+  os.environ.update(OMP_NUM_THREADS = '1', MKL_NUM_THREADS = '1', OPENBLAS_NUM_THREADS = '1')
+  # cap the batch size so there are at least as many tasks as workers, and queue the largest dimensions first
+  number_batch = max(1, min(args.nb, number_repetitions*len(number_dimensions_list)//number_processes))
+  tasks = [(i,number_dimensions,range(r,min(r+number_batch,number_repetitions))) for i, number_dimensions in reversed(list(enumerate(number_dimensions_list))) for r in range(0,number_repetitions,number_batch)]
+  with get_context("spawn").Pool(processes = number_processes) as pool:
+    results = pool.map(partial(run_batch, number_observations=number_observations, use_t_in_e=use_t_in_e, number_environments=number_environments), tasks, chunksize = 1)
+
+  for batch_results in results:
+    for r, i, pvalue_empty_ri, pvalue_x3_ri, pvalue_x2x3_ri in batch_results:
+      pvalue_empty[r,i] = pvalue_empty_ri
+      pvalue_x3[r,i] = pvalue_x3_ri
+      pvalue_x2x3[r,i] = pvalue_x2x3_ri
+  print(time.time() - starting_time)
 
   np.savetxt('syn-entner/pvalue_empty.csv', pvalue_empty, delimiter=",")
   np.savetxt('syn-entner/pvalue_x3.csv', pvalue_x3, delimiter=",")
@@ -178,6 +210,11 @@ if __name__ == "__main__":
       help='number of environments',
       default=3,
       type=int)
+  parser.add_argument(
+      '--nb',
+      help='maximum number of repetitions generated together in one batch',
+      default=10,
+      type=int)
   
   args = parser.parse_args()
   main(args)
\ No newline at end of file
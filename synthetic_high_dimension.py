@@ -13,89 +13,170 @@ Description: Code to test Algorithm 2 on synthetic dataset in high dimension
 
 """
 
+import os
 import time
 import argparse
+import multiprocessing
 import numpy as np
 import pandas as pd
+from functools import partial
 from sklearn.preprocessing import StandardScaler
-from scipy.special import softmax, expit
-from sklearn.model_selection import train_test_split
-from sklearn.linear_model import LogisticRegression, LinearRegression, RidgeCV
+from numba import njit
+from multiprocessing import get_context
+from sklearn.base import BaseEstimator, RegressorMixin
+from sklearn.linear_model import LogisticRegression, LinearRegression
 from causallib.estimation import IPW, Standardization, StratifiedStandardization
 
 from irm import get_irm_features
 
-def get_u(number_observations,number_dimensions):
-  u1 = np.random.uniform(1.0,2.0,(number_observations,1))
-  u2 = np.random.uniform(1.0,2.0,(number_observations,number_dimensions))
-  u3 = np.random.uniform(1.0,2.0,(number_observations,number_dimensions))
-  u4 = np.random.uniform(1.0,2.0,(number_observations,number_dimensions))
+rng = np.random.default_rng()
+
+def uniform(low,high,size):
+  return low + (high-low) * rng.random(size, dtype=np.float32)
+
+def get_u(number_repetitions,number_observations,number_dimensions):
+  u1 = uniform(1.0,2.0,(number_repetitions,number_observations,1))
+  u2 = uniform(1.0,2.0,(number_repetitions,number_observations,number_dimensions))
+  u3 = uniform(1.0,2.0,(number_repetitions,number_observations,number_dimensions))
+  u4 = uniform(1.0,2.0,(number_repetitions,number_observations,number_dimensions))
   return u1,u2,u3,u4
 
-def get_theta(number_dimensions,use_t_in_e,number_environments):
-  theta1 = np.random.uniform(1.0,2.0,(number_dimensions+1,1))
-  theta2 = np.random.uniform(1.0,2.0,(number_dimensions*2+1,number_dimensions))
-  theta3 = np.random.uniform(1.0,2.0,(number_dimensions*2,number_dimensions))
-  theta4 = np.random.uniform(1.0,2.0,(number_dimensions*2+1,1))
-  theta5 = np.random.uniform(1.0,2.0,(2,1))
+def get_theta(number_repetitions,number_dimensions,use_t_in_e,number_environments):
+  theta1 = uniform(1.0,2.0,(number_repetitions,number_dimensions+1,1))
+  theta2 = uniform(1.0,2.0,(number_repetitions,number_dimensions*2+1,number_dimensions))
+  theta3 = uniform(1.0,2.0,(number_repetitions,number_dimensions*2,number_dimensions))
+  theta4 = uniform(1.0,2.0,(number_repetitions,number_dimensions*2+1,1))
+  theta5 = uniform(1.0,2.0,(number_repetitions,2,1))
   if use_t_in_e == 0:
-    theta6 = np.concatenate((np.random.uniform(1.0,2.0,(1,1)), np.zeros((1,1)), np.random.uniform(-1.0,-2.0,(1,1))), axis = 1)
+    theta6 = np.concatenate((uniform(1.0,2.0,(number_repetitions,1,1)), np.zeros((number_repetitions,1,1), dtype=np.float32), uniform(-2.0,-1.0,(number_repetitions,1,1))), axis = 2)
   else:
-    theta6 = np.concatenate((np.random.uniform(1.0,2.0,(2,1)), np.zeros((2,1)), np.random.uniform(-1.0,-2.0,(2,1))), axis = 1)
+    theta6 = np.concatenate((uniform(1.0,2.0,(number_repetitions,2,1)), np.zeros((number_repetitions,2,1), dtype=np.float32), uniform(-2.0,-1.0,(number_repetitions,2,1))), axis = 2)
   return theta1, theta2, theta3, theta4, theta5, theta6
 
-def get_data(u1,u2,u3,u4,theta1,theta2,theta3,theta4,theta5,theta6,number_observations,number_dimensions,use_t_in_e,number_environments):
-  x1 = np.dot(np.concatenate((u1,u2),axis=1), theta1) + 0.1* np.random.normal(0,1,(number_observations,1))
-  x2 = np.dot(np.concatenate((x1,u2,u3),axis=1), theta2) + 0.1* np.random.normal(0,1,(number_observations,number_dimensions))
-  x3 = np.dot(np.concatenate((u3,u4),axis=1), theta3) + 0.1 * np.random.normal(0,1,(number_observations,number_dimensions))
-  t = np.random.binomial(1, expit(np.dot(np.concatenate((u1, x1), axis = 1), theta5)-np.mean(np.dot(np.concatenate((u1, x1), axis = 1), theta5))))
+@njit(cache=True, fastmath=True)
+def sample_treatment(z, rng):
+  t = np.empty(z.shape, dtype=np.int64)
+  for i in range(z.shape[0]):
+    t[i,0] = 1 if rng.random() < 1.0/(1.0+np.exp(-z[i,0])) else 0
+  return t
+
+@njit(cache=True, fastmath=True)
+def sample_environments(z, rng):
+  e = np.empty((z.shape[0],1), dtype=np.int64)
+  weights = np.empty(z.shape[1])
+  for i in range(z.shape[0]):
+    m = np.max(z[i])
+    s = 0.0
+    for k in range(z.shape[1]):
+      weights[k] = np.exp(z[i,k]-m)
+      s += weights[k]
+    u = rng.random() * s
+    k = 0
+    c = weights[0]
+    while u >= c and k < z.shape[1]-1:
+      k += 1
+      c += weights[k]
+    e[i,0] = k
+  return e
+
+def get_data(u1,u2,u3,u4,theta1,theta2,theta3,theta4,theta5,theta6,number_repetitions,number_observations,number_dimensions,use_t_in_e,number_environments):
+  x1 = np.matmul(u1, theta1[:,:1]) + np.matmul(u2, theta1[:,1:]) + 0.1* rng.standard_normal((number_repetitions,number_observations,1), dtype=np.float32)
+  x2 = np.matmul(x1, theta2[:,:1]) + np.matmul(u2, theta2[:,1:number_dimensions+1]) + np.matmul(u3, theta2[:,number_dimensions+1:]) + 0.1* rng.standard_normal((number_repetitions,number_observations,number_dimensions), dtype=np.float32)
+  x3 = np.matmul(u3, theta3[:,:number_dimensions]) + np.matmul(u4, theta3[:,number_dimensions:]) + 0.1 * rng.standard_normal((number_repetitions,number_observations,number_dimensions), dtype=np.float32)
+  z_t = np.matmul(u1, theta5[:,:1]) + np.matmul(x1, theta5[:,1:])
+  z_t -= np.mean(z_t, axis = 1, keepdims = True)
+  t = sample_treatment(z_t.reshape(-1,1), rng).reshape(z_t.shape)
   if use_t_in_e == 0:
-    probabilites = softmax(np.dot(x1, theta6)-np.mean(np.dot(x1, theta6), axis = 0), axis = 1)
+    z_e = np.matmul(x1, theta6)
   else:
-    probabilites = softmax(np.dot(np.concatenate((x1, t), axis = 1), theta6)-np.mean(np.dot(np.concatenate((x1, t), axis = 1), theta6), axis = 0 ),  axis = 1)
-  e = np.zeros((number_observations,1), dtype=int)
-  for i,probability in enumerate(probabilites):
-    e[i,:] = np.random.choice(np.arange(number_environments), p = probability)
-
-  zeros =  np.zeros((number_observations,1))
-  ones =  np.ones((number_observations,1))
-  noise = 0.1 * np.random.normal(0,1,(number_observations,1))
-  y = np.dot(np.concatenate((x2,u4,t),axis=1),theta4) + noise
-  y_0 = np.dot(np.concatenate((x2,u4,zeros),axis=1),theta4) + noise
-  y_1 = np.dot(np.concatenate((x2,u4,ones),axis=1),theta4) + noise
-
-  return x1,x2,x3,t,e,y,y_0,y_1
-
-def get_train_test_data(number_observations,number_dimensions,use_t_in_e,number_environments):
-  u1,u2,u3,u4 = get_u(number_observations,number_dimensions)
-  theta1, theta2, theta3, theta4, theta5, theta6 = get_theta(number_dimensions,use_t_in_e,number_environments)
-  x1,x2,x3,t,e,y,y_0,y_1 = get_data(u1,u2,u3,u4,theta1,theta2,theta3,theta4,theta5,theta6,number_observations,number_dimensions,use_t_in_e,number_environments)
-  true_ate = np.round(np.mean(y_1 - y_0),6)
-  features_train, features_test, t_train, t_test, y_train, y_test, e_train, e_test, y_0_train, y_0_test, y_1_train, y_1_test = train_test_split(np.concatenate((x1,x2,x3),axis=1), t, y, e, y_0, y_1, test_size=0.2)
-  x_train = pd.DataFrame(features_train)
-  x_train.columns = list(map(str, range(2*number_dimensions+1)))
-  x_train.columns = pd.MultiIndex.from_arrays([['x1' for i in range(1)] + ['x2' for i in range(number_dimensions)] + ['x3' for i in range(number_dimensions)], list(x_train.columns)]) 
-  t_train = pd.Series(t_train[:,0])
-  y_train = pd.Series(y_train[:,0])
-  e_train = pd.Series(e_train[:,0])
-  y_0_train = pd.Series(y_0_train[:,0])
-  y_1_train = pd.Series(y_1_train[:,0])
-  x_test = pd.DataFrame(features_test)
-  x_test.columns = list(map(str, range(2*number_dimensions+1)))
-  x_test.columns = pd.MultiIndex.from_arrays([['x1' for i in range(1)] + ['x2' for i in range(number_dimensions)] + ['x3' for i in range(number_dimensions)], list(x_test.columns)]) 
-  t_test = pd.Series(t_test[:,0])
-  y_test = pd.Series(y_test[:,0])
-  e_test = pd.Series(e_test[:,0])
-  y_0_test = pd.Series(y_0_test[:,0])
-  y_1_test = pd.Series(y_1_test[:,0])
-  return x_train, t_train, y_train, e_train, y_0_train, y_1_train, x_test, t_test, y_test, e_test, y_0_test, y_1_test, true_ate
+    z_e = np.matmul(x1, theta6[:,:1]) + np.matmul(t.astype(np.float32), theta6[:,1:])
+  z_e -= np.mean(z_e, axis = 1, keepdims = True)
+  if z_e.shape[-1] != number_environments:
+    raise ValueError("theta6 defines %d environments, but number_environments is %d" % (z_e.shape[-1], number_environments))
+  e = sample_environments(z_e.reshape(-1,z_e.shape[-1]), rng).reshape(z_t.shape)
+
+  noise = 0.1 * rng.standard_normal((number_repetitions,number_observations,1), dtype=np.float32)
+  y = np.matmul(x2, theta4[:,:number_dimensions]) + np.matmul(u4, theta4[:,number_dimensions:2*number_dimensions]) + t.astype(np.float32) * theta4[:,-1:] + noise
+
+  return x1,x2,x3,t,e,y
+
+def get_train_test_data(number_repetitions,number_observations,number_dimensions,use_t_in_e,number_environments):
+  u1,u2,u3,u4 = get_u(number_repetitions,number_observations,number_dimensions)
+  theta1, theta2, theta3, theta4, theta5, theta6 = get_theta(number_repetitions,number_dimensions,use_t_in_e,number_environments)
+  x1,x2,x3,t,e,y = get_data(u1,u2,u3,u4,theta1,theta2,theta3,theta4,theta5,theta6,number_repetitions,number_observations,number_dimensions,use_t_in_e,number_environments)
+  data = np.concatenate((x1,x2,x3,y,t,e),axis=2,dtype=np.float32)
+  del u1,u2,u3,u4,x1,x2,x3,t,e,y
+  col_slices = {'x1': slice(0,1), 'x2': slice(1,number_dimensions+1), 'x3': slice(number_dimensions+1,2*number_dimensions+1)}
+  number_test = int(np.ceil(0.2*number_observations))
+  for r in range(number_repetitions):
+    true_ate = round(float(theta4[r,-1,0]),6)
+    permutation = rng.permutation(number_observations)
+    data_train, data_test = data[r,permutation[number_test:]], data[r,permutation[:number_test]]
+    features_train, y_train, t_train, e_train = data_train[:,:2*number_dimensions+1], data_train[:,2*number_dimensions+1], data_train[:,2*number_dimensions+2].astype(np.int64), data_train[:,2*number_dimensions+3].astype(np.int64)
+    features_test, y_test, t_test, e_test = data_test[:,:2*number_dimensions+1], data_test[:,2*number_dimensions+1], data_test[:,2*number_dimensions+2].astype(np.int64), data_test[:,2*number_dimensions+3].astype(np.int64)
+    yield features_train, t_train, y_train, e_train, features_test, t_test, y_test, e_test, col_slices, true_ate
+
+class FastRidgeCV(BaseEstimator, RegressorMixin):
+  """Ridge regression with alpha chosen by leave-one-out error, as in RidgeCV.
+  One eigendecomposition of the centered Gram matrix is shared by all alphas.
+  """
+  def __init__(self, alphas=(1e-3, 1e-2, 1e-1, 1)):
+    self.alphas = alphas
+
+  def fit(self, X, y, sample_weight=None):
+    if sample_weight is not None:
+      raise ValueError("FastRidgeCV does not support sample_weight")
+    X = np.asarray(X, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64).reshape(-1)
+    X_mean = np.mean(X, axis=0)
+    y_mean = np.mean(y)
+    X_centered = X - X_mean
+    y_centered = y - y_mean
+    eigenvalues, V = np.linalg.eigh(np.dot(X_centered.T, X_centered))
+    XV = np.dot(X_centered, V)
+    XVty = np.dot(XV.T, y_centered)
+    shrinkage = 1.0 / (eigenvalues + np.asarray(self.alphas, dtype=np.float64).reshape(-1, 1))
+    residuals = y_centered.reshape(-1, 1) - np.dot(XV, (shrinkage * XVty).T)
+    leverages = np.dot(XV**2, shrinkage.T) + 1.0 / X.shape[0]
+    loo_errors = np.mean((residuals / (1 - leverages))**2, axis=0)
+    best = np.argmin(loo_errors)
+    self.alpha_ = self.alphas[best]
+    self.best_score_ = -loo_errors[best]
+    self.coef_ = np.dot(V, shrinkage[best] * XVty)
+    self.intercept_ = y_mean - np.dot(X_mean, self.coef_)
+    return self
+
+  def predict(self, X):
+    return np.dot(np.asarray(X, dtype=np.float64), self.coef_) + self.intercept_
 
 def get_effect(x_train, t_train, y_train, x_test, t_test):
-  std = Standardization(RidgeCV(alphas=[1e-3, 1e-2, 1e-1, 1]))
+  x_train = pd.DataFrame(x_train, columns = list(map(str, range(x_train.shape[1]))), copy = False)
+  x_test = pd.DataFrame(x_test, columns = list(map(str, range(x_test.shape[1]))), copy = False)
+  t_train = pd.Series(t_train, copy = False)
+  y_train = pd.Series(y_train, copy = False)
+  t_test = pd.Series(t_test, copy = False)
+  std = Standardization(FastRidgeCV(alphas=[1e-3, 1e-2, 1e-1, 1]))
   std.fit(x_train, t_train, y_train)
   pop_outcome = std.estimate_population_outcome(x_test, t_test, agg_func="mean")
   return std.estimate_effect(pop_outcome[1], pop_outcome[0])
 
+def run_batch(task,number_observations,use_t_in_e,number_environments,args):
+  i, number_dimensions, repetitions = task
+  results = []
+  for r, (features_train, t_train, y_train, e_train, features_test, t_test, y_test, e_test, col_slices, true_ate) in zip(repetitions, get_train_test_data(len(repetitions),number_observations,number_dimensions,use_t_in_e,number_environments)):
+    print(r+1, 2*number_dimensions+1)
+    effect_oracle = get_effect(features_train[:,col_slices['x2']], t_train, y_train, features_test[:,col_slices['x2']], t_test)
+    effect_baseline = get_effect(features_train, t_train, y_train, features_test, t_test)
+
+    x2x3 = slice(col_slices['x2'].start, col_slices['x3'].stop)
+    feature_indices = np.arange(features_train.shape[1])[x2x3]
+    irm_features_control, _ = get_irm_features(features_train[:,x2x3], t_train, y_train, e_train, number_environments, 0, feature_indices, args)
+    irm_features_treatment, _ = get_irm_features(features_train[:,x2x3], t_train, y_train, e_train, number_environments, 1, feature_indices, args)
+    effect_irm_control = get_effect(features_train[:,irm_features_control], t_train, y_train, features_test[:,irm_features_control], t_test)
+    effect_irm_treatment = get_effect(features_train[:,irm_features_treatment], t_train, y_train, features_test[:,irm_features_treatment], t_test)
+    results.append((r, i, true_ate, effect_oracle, effect_baseline, effect_irm_control, effect_irm_treatment))
+  return results
+
 def main(args):
 
   starting_time = time.time()
@@ -103,6 +184,7 @@ def main(args):
   number_observations = args.no
   use_t_in_e = args.use_t_in_e
   number_environments = args.ne
+  number_processes = multiprocessing.cpu_count()
   number_dimensions_list = [12, 22,32]
 
   effect_true = np.zeros((number_repetitions,len(number_dimensions_list)))
@@ -111,24 +193,22 @@ def main(args):
   effect_irm_control = np.zeros((number_repetitions,len(number_dimensions_list)))
   effect_irm_treatment = np.zeros((number_repetitions,len(number_dimensions_list)))
 
-  for r in range(number_repetitions):
-    print(r+1)
-    for i, number_dimensions in enumerate(number_dimensions_list):
-        print(2*number_dimensions+1)
-        x_train, t_train, y_train, e_train, y_0_train, y_1_train, x_test, t_test, y_test, e_test, y_0_test, y_1_test, true_ate = get_train_test_data(number_observations,number_dimensions,use_t_in_e,number_environments)
+  # spawned workers inherit these before importing numpy/torch, so each worker runs single-threaded BLAS/OpenMP
+  os.environ.update(OMP_NUM_THREADS = '1', MKL_NUM_THREADS = '1', OPENBLAS_NUM_THREADS = '1')
+  # cap the batch size so there are at least as many tasks as workers, and queue the largest dimensions first
+  number_batch = max(1, min(args.nb, number_repetitions*len(number_dimensions_list)//number_processes))
+  tasks = [(i,number_dimensions,range(r,min(r+number_batch,number_repetitions))) for i, number_dimensions in reversed(list(enumerate(number_dimensions_list))) for r in range(0,number_repetitions,number_batch)]
+  with get_context("spawn").Pool(processes = number_processes) as pool:
+    results = pool.map(partial(run_batch, number_observations=number_observations, use_t_in_e=use_t_in_e, number_environments=number_environments, args=args), tasks, chunksize = 1)
 
-        effect_true[r,i] = true_ate
-        effect_oracle[r,i] = get_effect(x_train[['x2']], t_train, y_train, x_test[['x2']], t_test)
-        effect_baseline[r,i] = get_effect(x_train[['x1','x2','x3']], t_train, y_train, x_test[['x1','x2','x3']], t_test)
-
-        irm_features_control, _ = get_irm_features(x_train[['x2','x3']], t_train, y_train, e_train, number_environments, 0, x_train.columns.droplevel()[1:], args)
-        irm_features_treatment, _ = get_irm_features(x_train[['x2','x3']], t_train, y_train, e_train, number_environments, 1, x_train.columns.droplevel()[1:], args)
-        x_train.columns = x_train.columns.droplevel()
-        x_test.columns = x_test.columns.droplevel()
-        effect_irm_control[r,i] = get_effect(x_train[irm_features_control], t_train, y_train, x_test[irm_features_control], t_test)
-        effect_irm_treatment[r,i] = get_effect(x_train[irm_features_treatment], t_train, y_train, x_test[irm_features_treatment], t_test)
-
-    print(time.time() - starting_time)
+  for batch_results in results:
+    for r, i, effect_true_ri, effect_oracle_ri, effect_baseline_ri, effect_irm_control_ri, effect_irm_treatment_ri in batch_results:
+      effect_true[r,i] = effect_true_ri
+      effect_oracle[r,i] = effect_oracle_ri
+      effect_baseline[r,i] = effect_baseline_ri
+      effect_irm_control[r,i] = effect_irm_control_ri
+      effect_irm_treatment[r,i] = effect_irm_treatment_ri
+  print(time.time() - starting_time)
 
   np.savetxt('synthetic_high_dimension/effect_true.csv', effect_true, delimiter=",")
   np.savetxt('synthetic_high_dimension/effect_baseline.csv', effect_baseline, delimiter=",")
@@ -178,6 +258,11 @@ if __name__ == "__main__":
       help='number of environments',
       default=3,
       type=int)
+  parser.add_argument(
+      '--nb',
+      help='maximum number of repetitions generated together in one batch',
+      default=10,
+      type=int)
   parser.add_argument(
       '--number_IRM_iterations',
       help='number of IRM iterations',